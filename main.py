@@ -1,8 +1,22 @@
 import asyncio
+import contextlib
 import httpx
+import json
 import re
+import time
 import uvicorn
 import datetime
+from collections import OrderedDict
+try:
+    # google-re2 ищет за линейное время; без него используем стандартный re
+    import re2 as _hotel_re
+except ImportError:
+    _hotel_re = re
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
@@ -22,17 +36,47 @@ HEADERS = {
     "Referer": "https://eto.travel/"
 }
 
-# --- Логика парсинга (без изменений) ---
-def parse_tourvisor_text(text: str):
-    hotels = []
-    matches = re.findall(r'\d+\s+name\s+([^,]+),.*?stars\s+(\d+).*?rating\s+([\d\.]+)', text, re.DOTALL)
-    seen_names = set()
-    for name, stars, rating in matches:
-        clean_name = name.strip()
-        if clean_name not in seen_names:
-            hotels.append({"name": clean_name, "stars": stars, "rating": rating})
-            seen_names.add(clean_name)
-    return hotels
+# Общий HTTP клиент: соединения с хостами tourvisor переиспользуются между вызовами
+http_client = httpx.AsyncClient(
+    headers=HEADERS,
+    http2=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+)
+
+# --- Логика парсинга ---
+# DOTALL задан в самом шаблоне, чтобы он компилировался и в re2
+_HOTEL_RE = _hotel_re.compile(r'(?s)\d+\s+name\s+([^,]+),.*?stars\s+(\d+).*?rating\s+([\d\.]+)')
+# Признак завершённого поиска в ответе modresult.php (поле final, которое
+# читает и mcp_server.py); может и не встретиться, см. RESULT_STALE_POLLS
+_FINAL_RE = re.compile(r'"final"\s*:\s*(?:true|1)')
+
+# Сколько максимум ждать результатов поиска (секунды)
+RESULT_DEADLINE = 10.0
+# После скольких опросов подряд без новых отелей считаем поиск завершённым
+RESULT_STALE_POLLS = 3
+# Сколько отелей показываем в ответе
+TOP_HOTELS = 15
+# Сколько символов ответа modresult.php разбираем в поисках отелей
+RESULT_TEXT_LIMIT = 262_144
+
+# Кэш готовых ответов поиска: (страна, ночи от, ночи до, день) -> (время, текст)
+SEARCH_CACHE_TTL = 90.0
+SEARCH_CACHE_SIZE = 128
+_search_cache: OrderedDict = OrderedDict()
+
+def parse_tourvisor_text(text: str, limit: int | None = None, max_chars: int | None = None):
+    if max_chars is not None:
+        text = text[:max_chars]
+    hotels = {}
+    for match in _HOTEL_RE.finditer(text):
+        name = match.group(1).strip()
+        if name not in hotels:
+            hotels[name] = {"name": name, "stars": match.group(2), "rating": match.group(3)}
+            # Дальше текст не разбираем: лишние отели всё равно не покажем
+            if limit is not None and len(hotels) >= limit:
+                break
+    return list(hotels.values())
 
 # --- Регистрация инструментов ---
 
@@ -69,11 +113,29 @@ async def handle_call_tool(name: str, arguments: dict | None) -> list[TextConten
     nights_from = arguments.get("nights_from", 7)
     nights_to = arguments.get("nights_to", 14)
 
+    # Дата берётся один раз: по ней же строится ключ кэша, так что записи
+    # сменяются вместе с окном поиска
+    today = datetime.date.today()
+
     # --- Бизнес-логика поиска (перенесена из FastMCP версии) ---
-    async with httpx.AsyncClient(headers=HEADERS, timeout=30.0) as client:
-        start_date = (datetime.date.today() + datetime.timedelta(days=7)).strftime("%Y-%m-%d")
-        end_date = (datetime.date.today() + datetime.timedelta(days=14)).strftime("%Y-%m-%d")
-        
+    client = http_client
+    start_date = (today + datetime.timedelta(days=7)).isoformat()
+    end_date = (today + datetime.timedelta(days=14)).isoformat()
+
+    try:
+        # Аргументы приходят от клиента как есть: приводим к int до построения
+        # ключа кэша, чтобы 4 и "4" не давали разных записей
+        country_code = int(country_code)
+        nights_from = int(nights_from)
+        nights_to = int(nights_to)
+
+        # Повторный запрос с теми же параметрами отдаём из кэша
+        cache_key = (country_code, nights_from, nights_to, today.toordinal())
+        cached = _search_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+            _search_cache.move_to_end(cache_key)
+            return [TextContent(type="text", text=cached[1])]
+
         tv_payload = {
              "adultsCount": 2,
              "countryIds": [country_code],
@@ -84,38 +146,62 @@ async def handle_call_tool(name: str, arguments: dict | None) -> list[TextConten
              "nightsTo": nights_to,
         }
 
-        try:
-            # 1. Запуск
-            print(f"Запускаем поиск для страны {country_code}...")
-            resp = await client.post("https://stat.tourvisor.ru/api/v1/searches", json=tv_payload)
-            data = resp.json()
-            
-            request_id = data.get("result", {}).get("requestid")
-            if not request_id:
-                return [TextContent(type="text", text=f"Ошибка запуска API: {data}")]
-            
-            print(f"Поиск ID: {request_id}. Ждем 8 сек...")
-            await asyncio.sleep(8) # Ждем наполнения
-            
-            # 2. Получение результатов
-            result_url = f"https://search3.tourvisor.ru/modresult.php?requestid={request_id}&referrer=https://eto.travel/"
+        # 1. Запуск
+        print(f"Запускаем поиск для страны {country_code}...")
+        resp = await client.post("https://stat.tourvisor.ru/api/v1/searches", json=tv_payload)
+        data = _json_loads(resp.content)
+        
+        request_id = data.get("result", {}).get("requestid")
+        if not request_id:
+            return [TextContent(type="text", text=f"Ошибка запуска API: {data}")]
+        
+        print(f"Поиск ID: {request_id} ({resp.http_version}). Ждем результатов...")
+        
+        # 2. Получение результатов: опрашиваем, пока не наберётся TOP_HOTELS отелей,
+        # поиск не завершится или число отелей не перестанет расти
+        result_url = f"https://search3.tourvisor.ru/modresult.php?requestid={request_id}&referrer=https://eto.travel/"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RESULT_DEADLINE
+        delay = 0.5
+        hotels = []
+        stale_polls = 0
+        while loop.time() < deadline:
+            await asyncio.sleep(delay)
             result_resp = await client.get(result_url)
             
-            # 3. Парсинг
-            hotels = parse_tourvisor_text(result_resp.text)
-            
-            if not hotels:
-                 return [TextContent(type="text", text="Туры не найдены (пустой ответ).")]
-            
-            # Формирование ответа
-            output = [f"Найдено {len(hotels)} отелей (Топ-15):"]
-            for h in hotels[:15]:
-                output.append(f"- {h['name']} {h['stars']}* (Рейтинг: {h['rating']})")
-            
-            return [TextContent(type="text", text="\n".join(output))]
+            # 3. Парсинг: ответ содержит все найденные к этому моменту отели,
+            # поэтому новыми считаем только прирост их числа
+            found = parse_tourvisor_text(result_resp.text, limit=TOP_HOTELS, max_chars=RESULT_TEXT_LIMIT)
+            if len(found) > len(hotels):
+                hotels = found
+                stale_polls = 0
+                delay = 0.5
+            else:
+                stale_polls += 1
+                delay = min(delay * 2, 2.0)
+            if len(hotels) >= TOP_HOTELS or _FINAL_RE.search(result_resp.text):
+                break
+            if hotels and stale_polls >= RESULT_STALE_POLLS:
+                break
+        
+        if not hotels:
+             return [TextContent(type="text", text="Туры не найдены (пустой ответ).")]
+        
+        # Формирование ответа
+        output = [f"Топ-{len(hotels)} отелей:"]
+        for h in hotels:
+            output.append(f"- {h['name']} {h['stars']}* (Рейтинг: {h['rating']})")
+        
+        text = "\n".join(output)
+        _search_cache[cache_key] = (time.monotonic(), text)
+        _search_cache.move_to_end(cache_key)
+        if len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+        
+        return [TextContent(type="text", text=text)]
 
-        except Exception as e:
-            return [TextContent(type="text", text=f"Ошибка выполнения: {str(e)}")]
+    except Exception as e:
+        return [TextContent(type="text", text=f"Ошибка выполнения: {str(e)}")]
 
 # --- Настройка SSE сервера (Starlette + CORS) ---
 
@@ -137,6 +223,12 @@ async def messages_endpoint(request):
     """Эндпоинт для отправки сообщений (POST)"""
     await transport.handle_post_message(request.scope, request.receive, request._send)
 
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Закрываем общий HTTP клиент при остановке сервера"""
+    yield
+    await http_client.aclose()
+
 if __name__ == "__main__":
     middleware = [
         Middleware(
@@ -152,7 +244,8 @@ if __name__ == "__main__":
             Route("/sse", endpoint=sse_endpoint, methods=["GET"]),
             Route("/messages", endpoint=messages_endpoint, methods=["POST"]),
         ],
-        middleware=middleware
+        middleware=middleware,
+        lifespan=lifespan
     )
 
     uvicorn.run(app)
@@ -2,13 +2,22 @@ import asyncio
 import json
 import logging
 import os
+import random
 import re
 import sys
+import time
+from collections import defaultdict
+from contextlib import aclosing
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional
-from urllib.parse import urlencode
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Type
 
 import httpx
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from pydantic import BaseModel, ConfigDict, Field
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
 from mcp.types import (
@@ -29,15 +38,230 @@ REFERRER = "https://eto.travel/search/"
 # Путь к файлу справочника (можно переопределить через переменную окружения)
 DICTIONARY_FILE = os.getenv("DICTIONARY_FILE", "travel-dictionary.json")
 
+# Ответы инструментов читает MCP клиент, поэтому отступы включаем только для отладки
+_JSON_INDENT = bool(os.getenv("MCP_DEBUG"))
+
+# Поиск requestid в HTML странице поиска
+_REQUEST_ID_RE = re.compile(r'requestid["\']?\s*[:=]\s*["\']?(\d+)', re.IGNORECASE)
+# Сколько символов предыдущего фрагмента хранить, чтобы не потерять совпадение на стыке
+_REQUEST_ID_OVERLAP = 256
+
+# Пауза между опросами результатов поиска (секунды)
+POLL_MIN_DELAY = 0.25
+POLL_MAX_DELAY = 1.0
+# Сколько всего ждать результатов поиска (секунды)
+POLL_DEADLINE = 10.0
+
+# Сколько туров возвращает search_tours и до скольки считает найденные
+SEARCH_TOURS_LIMIT = 50
+SEARCH_COUNT_LIMIT = 200
+
+# Время жизни кэша справочных ответов API (секунды)
+HOTEL_TYPES_TTL = 3600
+HOTELS_TTL = 1800
+
+
+def _json_loads(data: bytes) -> Any:
+    """Разобрать JSON: orjson, если установлен, иначе стандартный json"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Сериализовать в UTF-8 JSON: orjson, если установлен, иначе стандартный json"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+    return _json_text(obj, indent).encode("utf-8")
+
+
+def _json_text(obj: Any, indent: bool = False) -> str:
+    """Сериализовать в JSON строку для TextContent
+    
+    Без orjson строку отдаёт сам json.dumps, без лишнего кодирования в UTF-8 и обратно.
+    """
+    if orjson is not None:
+        return _json_dumps(obj, indent).decode("utf-8")
+    return json.dumps(
+        obj,
+        ensure_ascii=False,
+        indent=2 if indent else None,
+        separators=None if indent else (",", ":")
+    )
+
+
+def _nested(data: Any, *path: str, default: Any = None) -> Any:
+    """Достать значение по цепочке ключей без промежуточных пустых словарей"""
+    for key in path:
+        if not isinstance(data, dict):
+            return default
+        data = data.get(key)
+        if data is None:
+            return default
+    return data
+
+
+@dataclass(slots=True, frozen=True)
+class _IndexEntry:
+    """Элемент справочника с заранее приведённым к нижнему регистру названием"""
+    name_lower: str
+    item: Dict[str, Any]
+
+
+class _ToolArgs(BaseModel):
+    """Базовая модель аргументов инструмента: лишние поля запрещены"""
+    model_config = ConfigDict(extra="forbid")
+
+
+class LoadDictionaryArgs(_ToolArgs):
+    force_reload: bool = Field(False, description="Принудительно загрузить из API вместо локального файла")
+
+
+class SearchToursArgs(_ToolArgs):
+    country_id: int = Field(description="ID страны назначения (из справочника)")
+    departure_id: int = Field(1, description="ID города отправления (из справочника). По умолчанию 1 (Москва)")
+    nights_from: int = Field(7, description="Минимальное количество ночей")
+    nights_to: int = Field(14, description="Максимальное количество ночей")
+    date_from: str = Field(description="Дата начала поиска в формате DD.MM.YYYY")
+    date_to: str = Field(description="Дата окончания поиска в формате DD.MM.YYYY")
+    adults: int = Field(2, description="Количество взрослых")
+    children: int = Field(0, description="Количество детей")
+    region_ids: Optional[List[int]] = Field(None, description="Список ID регионов для поиска (опционально)")
+    hotel_ids: Optional[List[int]] = Field(None, description="Список ID отелей для поиска (опционально)")
+
+
+class HotelTypesArgs(_ToolArgs):
+    country_id: int = Field(description="ID страны")
+
+
+class HotelsByCountryArgs(_ToolArgs):
+    country_id: int = Field(description="ID страны")
+    departure_id: int = Field(1, description="ID города отправления (по умолчанию 1 - Москва)")
+
+
+class FindCountryArgs(_ToolArgs):
+    query: str = Field(description="Название страны для поиска (например: 'Египет', 'Турция', 'Тайланд')")
+
+
+class FindRegionArgs(_ToolArgs):
+    country_id: int = Field(description="ID страны")
+    query: str = Field(description="Название региона/курорта")
+
+
+class PopularCountriesArgs(_ToolArgs):
+    pass
+
+
+# Инструменты сервера: имя совпадает с методом EtoTravelMCP, схема берётся из модели
+_TOOL_SPECS: Tuple[Tuple[str, str, Type[_ToolArgs]], ...] = (
+    (
+        "load_dictionary",
+        "Загрузить справочник стран, регионов, городов отправления и операторов. Вызови этот инструмент первым перед любым поиском.",
+        LoadDictionaryArgs
+    ),
+    (
+        "search_tours",
+        "Поиск туров по заданным параметрам. Возвращает список доступных туров с ценами и деталями.",
+        SearchToursArgs
+    ),
+    (
+        "get_hotel_types",
+        "Получить список доступных типов отелей для страны (отель, апартаменты, вилла и т.д.)",
+        HotelTypesArgs
+    ),
+    (
+        "get_hotels_by_country",
+        "Получить список всех отелей в стране с их характеристиками (звезды, регион, рейтинг)",
+        HotelsByCountryArgs
+    ),
+    (
+        "find_country",
+        "Найти страну по названию и получить её ID и доступные направления",
+        FindCountryArgs
+    ),
+    (
+        "find_region",
+        "Найти регион/курорт по названию в конкретной стране",
+        FindRegionArgs
+    ),
+    (
+        "get_popular_countries",
+        "Получить список популярных стран для туризма",
+        PopularCountriesArgs
+    )
+)
+
+# Схемы инструментов не меняются, поэтому список Tool собирается один раз на процесс
+_TOOLS: List[Tool] = [
+    Tool(name=name, description=description, inputSchema=model.model_json_schema())
+    for name, description, model in _TOOL_SPECS
+]
+
 
 class EtoTravelMCP:
     """MCP сервер для работы с eto.travel API"""
     
+    __slots__ = (
+        "server",
+        "session",
+        "dictionary",
+        "dictionary_path",
+        "dictionary_meta_path",
+        "_dictionary_file_ok",
+        "http_client",
+        "_poll_client",
+        "_countries_lc",
+        "_regions_by_country",
+        "_popular_countries",
+        "_stats",
+        "_cache",
+        "_cache_locks",
+        "_dictionary_lock",
+        "_prefetch",
+        "_dispatch"
+    )
+    
     def __init__(self, dictionary_path: Optional[str] = None):
         self.server = Server("eto-travel-mcp")
-        self.session: Optional[str] = None
+        # Сессия tourvisor выдаётся один раз и не меняется
+        self.session: str = "0e56548e3e4ed302e692f3afc717a163324fe9526f01957108cfe5b656cbbe413ef653bcc317e817c0c4687a2b0536611942eeb3ebbe6bced2264ba434f462a787f83474aa5e2122f03b098cc16f285f024ade46527e24c1542eaa89605d5399ca6a71e337332188e0ad327a9738fa62a5e42c872dc03236bf38e1113686190d38812c51c49a21b662fe9351ad"
         self.dictionary: Dict[str, Any] = {}
-        self.http_client = httpx.AsyncClient(timeout=30.0)
+        
+        # Индексы справочника, строятся один раз после загрузки
+        self._countries_lc: List[_IndexEntry] = []
+        self._regions_by_country: Dict[int, List[_IndexEntry]] = defaultdict(list)
+        self._popular_countries: Tuple[Dict[str, Any], ...] = ()
+        self._stats: Dict[str, Any] = {}
+        
+        # Кэш ответов API: ключ -> (момент истечения, результат)
+        self._cache: Dict[Tuple, Tuple[float, Any]] = {}
+        self._cache_locks: Dict[Tuple, asyncio.Lock] = {}
+        # Одновременные вызовы load_dictionary ждут одну загрузку
+        self._dictionary_lock = asyncio.Lock()
+        # Фоновая загрузка справочника, запускается в run() до рукопожатия MCP
+        self._prefetch: Optional[asyncio.Task] = None
+        # Все запросы идут на несколько одних и тех же хостов, поэтому держим
+        # соединения открытыми и мультиплексируем запросы через HTTP/2
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(
+                max_keepalive_connections=30,
+                max_connections=100,
+                keepalive_expiry=60.0
+            ),
+            headers={"User-Agent": "eto-travel-mcp/1.0"}
+        )
+        # Отдельный клиент для опроса результатов, чтобы соединение с search3
+        # не вытеснялось из общего пула между опросами
+        self._poll_client = httpx.AsyncClient(
+            base_url=SEARCH_URL,
+            http2=True,
+            timeout=15.0,
+            limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=120.0),
+            headers={"User-Agent": "eto-travel-mcp/1.0"}
+        )
         
         # Определяем путь к файлу справочника
         if dictionary_path:
@@ -46,6 +270,11 @@ class EtoTravelMCP:
             # Ищем файл рядом со скриптом
             script_dir = Path(__file__).parent
             self.dictionary_path = script_dir / DICTIONARY_FILE
+        # ETag/Last-Modified сохранённого справочника для условных запросов к API
+        self.dictionary_meta_path = self.dictionary_path.with_name(self.dictionary_path.name + ".meta")
+        # Файл справочника на диске заведомо разбирается: только тогда можно
+        # спрашивать API об изменениях и получать 304
+        self._dictionary_file_ok = False
         
         logger.info(f"📂 Путь к справочнику: {self.dictionary_path}")
         
@@ -55,219 +284,83 @@ class EtoTravelMCP:
     def setup_tools(self):
         """Регистрация доступных инструментов"""
         
+        # Имя инструмента -> (модель аргументов, обработчик)
+        self._dispatch: Dict[str, Tuple[Type[_ToolArgs], Callable[..., Awaitable[Dict[str, Any]]]]] = {
+            name: (model, getattr(self, name))
+            for name, _, model in _TOOL_SPECS
+        }
+        
         @self.server.list_tools()
         async def list_tools() -> List[Tool]:
-            return [
-                Tool(
-                    name="load_dictionary",
-                    description="Загрузить справочник стран, регионов, городов отправления и операторов. Вызови этот инструмент первым перед любым поиском.",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "force_reload": {
-                                "type": "boolean",
-                                "description": "Принудительно загрузить из API вместо локального файла",
-                                "default": False
-                            }
-                        },
-                        "required": []
-                    }
-                ),
-                Tool(
-                    name="search_tours",
-                    description="Поиск туров по заданным параметрам. Возвращает список доступных туров с ценами и деталями.",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "country_id": {
-                                "type": "integer",
-                                "description": "ID страны назначения (из справочника)"
-                            },
-                            "departure_id": {
-                                "type": "integer",
-                                "description": "ID города отправления (из справочника). По умолчанию 1 (Москва)",
-                                "default": 1
-                            },
-                            "nights_from": {
-                                "type": "integer",
-                                "description": "Минимальное количество ночей",
-                                "default": 7
-                            },
-                            "nights_to": {
-                                "type": "integer",
-                                "description": "Максимальное количество ночей",
-                                "default": 14
-                            },
-                            "date_from": {
-                                "type": "string",
-                                "description": "Дата начала поиска в формате DD.MM.YYYY"
-                            },
-                            "date_to": {
-                                "type": "string",
-                                "description": "Дата окончания поиска в формате DD.MM.YYYY"
-                            },
-                            "adults": {
-                                "type": "integer",
-                                "description": "Количество взрослых",
-                                "default": 2
-                            },
-                            "children": {
-                                "type": "integer",
-                                "description": "Количество детей",
-                                "default": 0
-                            },
-                            "region_ids": {
-                                "type": "array",
-                                "items": {"type": "integer"},
-                                "description": "Список ID регионов для поиска (опционально)"
-                            },
-                            "hotel_ids": {
-                                "type": "array",
-                                "items": {"type": "integer"},
-                                "description": "Список ID отелей для поиска (опционально)"
-                            }
-                        },
-                        "required": ["country_id", "date_from", "date_to"]
-                    }
-                ),
-                Tool(
-                    name="get_hotel_types",
-                    description="Получить список доступных типов отелей для страны (отель, апартаменты, вилла и т.д.)",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "country_id": {
-                                "type": "integer",
-                                "description": "ID страны"
-                            }
-                        },
-                        "required": ["country_id"]
-                    }
-                ),
-                Tool(
-                    name="get_hotels_by_country",
-                    description="Получить список всех отелей в стране с их характеристиками (звезды, регион, рейтинг)",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "country_id": {
-                                "type": "integer",
-                                "description": "ID страны"
-                            },
-                            "departure_id": {
-                                "type": "integer",
-                                "description": "ID города отправления (по умолчанию 1 - Москва)",
-                                "default": 1
-                            }
-                        },
-                        "required": ["country_id"]
-                    }
-                ),
-                Tool(
-                    name="find_country",
-                    description="Найти страну по названию и получить её ID и доступные направления",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "Название страны для поиска (например: 'Египет', 'Турция', 'Тайланд')"
-                            }
-                        },
-                        "required": ["query"]
-                    }
-                ),
-                Tool(
-                    name="find_region",
-                    description="Найти регион/курорт по названию в конкретной стране",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {
-                            "country_id": {
-                                "type": "integer",
-                                "description": "ID страны"
-                            },
-                            "query": {
-                                "type": "string",
-                                "description": "Название региона/курорта"
-                            }
-                        },
-                        "required": ["country_id", "query"]
-                    }
-                ),
-                Tool(
-                    name="get_popular_countries",
-                    description="Получить список популярных стран для туризма",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {},
-                        "required": []
-                    }
-                )
-            ]
+            return _TOOLS
         
         @self.server.call_tool()
         async def call_tool(name: str, arguments: Any) -> List[TextContent]:
             try:
-                if name == "load_dictionary":
-                    force_reload = arguments.get("force_reload", False) if arguments else False
-                    result = await self.load_dictionary(force_reload=force_reload)
-                elif name == "search_tours":
-                    result = await self.search_tours(**arguments)
-                elif name == "get_hotel_types":
-                    result = await self.get_hotel_types(**arguments)
-                elif name == "get_hotels_by_country":
-                    result = await self.get_hotels_by_country(**arguments)
-                elif name == "find_country":
-                    result = await self.find_country(**arguments)
-                elif name == "find_region":
-                    result = await self.find_region(**arguments)
-                elif name == "get_popular_countries":
-                    result = await self.get_popular_countries()
+                entry = self._dispatch.get(name)
+                if entry:
+                    model, handler = entry
+                    # Проверяем типы и обязательные поля до вызова обработчика
+                    args = model.model_validate(arguments or {})
+                    result = await handler(**args.model_dump())
                 else:
                     result = {"error": f"Unknown tool: {name}"}
-                    
+                
                 return [TextContent(
                     type="text",
-                    text=json.dumps(result, ensure_ascii=False, indent=2)
+                    text=_json_text(result, _JSON_INDENT)
                 )]
             except Exception as e:
                 logger.error(f"Error in tool {name}: {str(e)}")
                 return [TextContent(
                     type="text",
-                    text=json.dumps({"error": str(e)}, ensure_ascii=False)
+                    text=_json_text({"error": str(e)})
                 )]
     
-    async def ensure_session(self):
-        """Получить session ID если его нет"""
-        if not self.session:
-            self.session = "0e56548e3e4ed302e692f3afc717a163324fe9526f01957108cfe5b656cbbe413ef653bcc317e817c0c4687a2b0536611942eeb3ebbe6bced2264ba434f462a787f83474aa5e2122f03b098cc16f285f024ade46527e24c1542eaa89605d5399ca6a71e337332188e0ad327a9738fa62a5e42c872dc03236bf38e1113686190d38812c51c49a21b662fe9351ad"
-    
-    def _load_dictionary_from_file(self) -> Optional[Dict[str, Any]]:
-        """Загрузить справочник из локального файла"""
+    async def _load_dictionary_from_file(self) -> Optional[Dict[str, Any]]:
+        """Загрузить справочник из локального файла
+        
+        Чтение и разбор файла выполняются в отдельном потоке, чтобы не блокировать
+        обработку других запросов.
+        """
         try:
             if not self.dictionary_path.exists():
                 logger.warning(f"📁 Файл справочника не найден: {self.dictionary_path}")
+                self._dictionary_file_ok = False
                 return None
             
             logger.info(f"📖 Загрузка справочника из файла: {self.dictionary_path}")
-            with open(self.dictionary_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = await asyncio.to_thread(
+                lambda: _json_loads(self.dictionary_path.read_bytes())
+            )
             
             logger.info("✅ Справочник загружен из файла")
+            self._dictionary_file_ok = True
             return data
             
         except json.JSONDecodeError as e:
             logger.error(f"❌ Ошибка парсинга JSON: {e}")
+            self._dictionary_file_ok = False
             return None
         except Exception as e:
             logger.error(f"❌ Ошибка чтения файла: {e}")
+            self._dictionary_file_ok = False
             return None
     
-    async def _load_dictionary_from_api(self) -> Optional[Dict[str, Any]]:
-        """Загрузить справочник из API"""
-        await self.ensure_session()
+    async def _load_dictionary_from_api(
+        self,
+        conditional: bool = False
+    ) -> Tuple[Optional[Dict[str, Any]], str]:
+        """Загрузить справочник из API
         
+        Args:
+            conditional: файл на диске разбирается, поэтому API можно спросить
+                только об изменениях (If-None-Match/If-Modified-Since)
+        
+        Returns:
+            (справочник, источник): "file", если API ответил 304 и справочник
+            взят из памяти или прочитан из файла, иначе "api"
+        """
         params = {
             "type": "departure,allcountry,country,region,subregions,operator",
             "formmode": "0",
@@ -279,29 +372,81 @@ class EtoTravelMCP:
             "session": self.session
         }
         
-        url = f"{BASE_URL}/xml/listdev.php?{urlencode(params)}"
-        
         try:
+            # Если исправный файл уже есть, спрашиваем API только об изменениях
+            headers = {}
+            if conditional:
+                validators = await asyncio.to_thread(self._read_dictionary_validators)
+                if validators.get("etag"):
+                    headers["If-None-Match"] = validators["etag"]
+                if validators.get("last_modified"):
+                    headers["If-Modified-Since"] = validators["last_modified"]
+            
             logger.info("🌐 Загрузка справочника из API...")
-            response = await self.http_client.get(url)
+            response = await self.http_client.get(
+                f"{BASE_URL}/xml/listdev.php",
+                params=params,
+                headers=headers
+            )
+            if response.status_code == 304:
+                logger.info("✅ Справочник в API не изменился, используем файл")
+                # Файл прочитан или записан этим процессом, значит в памяти его содержимое
+                if self.dictionary:
+                    return self.dictionary, "file"
+                data = await self._load_dictionary_from_file()
+                if data:
+                    return data, "file"
+                # Файл испортился после проверки: запрашиваем справочник целиком
+                logger.warning("⚠️ Файл справочника не читается, повторяем запрос без условий")
+                return await self._load_dictionary_from_api(conditional=False)
+            
             response.raise_for_status()
-            data = response.json()
+            data = _json_loads(response.content)
             
             logger.info("✅ Справочник загружен из API")
             
-            # Сохраняем в файл для будущего использования
+            # Сохраняем в файл для будущего использования: пишем байты ответа как есть
+            # во временный файл и атомарно подменяем, чтобы не оставить обрезанный JSON
             try:
-                with open(self.dictionary_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
+                validators = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")
+                }
+                await asyncio.to_thread(self._write_dictionary_file, response.content, validators)
+                self._dictionary_file_ok = True
                 logger.info(f"💾 Справочник сохранён в файл: {self.dictionary_path}")
             except Exception as e:
                 logger.warning(f"⚠️ Не удалось сохранить справочник в файл: {e}")
             
-            return data
+            return data, "api"
             
         except Exception as e:
             logger.error(f"❌ Ошибка загрузки из API: {e}")
-            return None
+            return None, "api"
+    
+    def _read_dictionary_validators(self) -> Dict[str, Optional[str]]:
+        """Прочитать ETag/Last-Modified, с которыми был сохранён справочник"""
+        if not self.dictionary_path.exists() or not self.dictionary_meta_path.exists():
+            return {}
+        try:
+            return _json_loads(self.dictionary_meta_path.read_bytes())
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать {self.dictionary_meta_path}: {e}")
+            return {}
+    
+    def _write_dictionary_file(self, content: bytes, validators: Dict[str, Optional[str]]):
+        """Атомарно записать справочник в файл вместе с его ETag/Last-Modified"""
+        tmp_path = self.dictionary_path.with_suffix(".json.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, self.dictionary_path)
+        
+        if any(validators.values()):
+            tmp_meta = self.dictionary_meta_path.with_name(self.dictionary_meta_path.name + ".tmp")
+            tmp_meta.write_bytes(_json_dumps(validators))
+            os.replace(tmp_meta, self.dictionary_meta_path)
+        else:
+            # Старые валидаторы относятся к прежнему содержимому файла
+            self.dictionary_meta_path.unlink(missing_ok=True)
     
     async def load_dictionary(self, force_reload: bool = False) -> Dict[str, Any]:
         """Загрузить справочник стран, регионов и городов
@@ -309,33 +454,40 @@ class EtoTravelMCP:
         Args:
             force_reload: Принудительно загрузить из API вместо файла
         """
+        async with self._dictionary_lock:
+            return await self._load_dictionary(force_reload)
+    
+    async def _ensure_dictionary(self) -> None:
+        """Дождаться справочника: фоновой предзагрузки, если она идёт, иначе загрузить"""
+        if self.dictionary:
+            return
+        if self._prefetch is not None:
+            # shield: отмена одного вызова инструмента не должна прерывать общую загрузку
+            await asyncio.shield(self._prefetch)
+        if not self.dictionary:
+            await self.load_dictionary()
+    
+    async def _load_dictionary(self, force_reload: bool) -> Dict[str, Any]:
+        """Загрузить справочник (вызывается под self._dictionary_lock)"""
         # Если справочник уже загружен и не требуется перезагрузка
         if self.dictionary and not force_reload:
-            stats = {
-                "countries_count": len(self.dictionary.get("lists", {}).get("allcountry", {}).get("country", [])),
-                "departures_count": len(self.dictionary.get("lists", {}).get("departures", {}).get("departure", [])),
-                "regions_count": len(self.dictionary.get("lists", {}).get("regions", {}).get("region", [])),
-                "loaded": True,
-                "source": "cache"
-            }
             return {
                 "success": True,
                 "message": "Справочник уже загружен (используется кэш)",
-                "stats": stats
+                "stats": self._stats | {"source": "cache"}
             }
         
         # Пытаемся загрузить из файла (если не требуется принудительная перезагрузка)
         if not force_reload:
-            data = self._load_dictionary_from_file()
+            data = await self._load_dictionary_from_file()
             if data:
                 self.dictionary = data
                 source = "file"
             else:
-                # Fallback на API
-                data = await self._load_dictionary_from_api()
+                # Fallback на API: файл не прочитался, поэтому запрос без условий
+                data, source = await self._load_dictionary_from_api(conditional=False)
                 if data:
                     self.dictionary = data
-                    source = "api"
                 else:
                     return {
                         "success": False,
@@ -343,35 +495,94 @@ class EtoTravelMCP:
                     }
         else:
             # Принудительная загрузка из API
-            data = await self._load_dictionary_from_api()
+            data, source = await self._load_dictionary_from_api(conditional=self._dictionary_file_ok)
             if data:
                 self.dictionary = data
-                source = "api_forced"
+                # При 304 источник остаётся "file": API лишь подтвердил актуальность файла
+                if source == "api":
+                    source = "api_forced"
             else:
                 return {
                     "success": False,
                     "error": "Не удалось загрузить справочник из API"
                 }
         
-        # Подготовим статистику
-        stats = {
-            "countries_count": len(self.dictionary.get("lists", {}).get("allcountry", {}).get("country", [])),
-            "departures_count": len(self.dictionary.get("lists", {}).get("departures", {}).get("departure", [])),
-            "regions_count": len(self.dictionary.get("lists", {}).get("regions", {}).get("region", [])),
-            "loaded": True,
-            "source": source
-        }
+        self._build_indexes()
         
         return {
             "success": True,
             "message": f"Справочник успешно загружен из {source}",
-            "stats": stats
+            "stats": self._stats | {"source": source}
+        }
+    
+    def _build_indexes(self):
+        """Построить индексы и статистику справочника"""
+        lists = _nested(self.dictionary, "lists", default={})
+        countries = _nested(lists, "allcountry", "country", default=[])
+        departures = _nested(lists, "departures", "departure", default=[])
+        regions = _nested(lists, "regions", "region", default=[])
+        
+        self._stats = {
+            "countries_count": len(countries),
+            "departures_count": len(departures),
+            "regions_count": len(regions),
+            "loaded": True
         }
+        
+        self._countries_lc = [_IndexEntry(c.get("name", "").lower(), c) for c in countries]
+        self._popular_countries = tuple(c for c in countries if c.get("popular") == 1)
+        
+        self._regions_by_country = defaultdict(list)
+        for r in regions:
+            self._regions_by_country[r.get("country")].append(_IndexEntry(r.get("name", "").lower(), r))
+    
+    async def _cached(
+        self,
+        key: Tuple,
+        ttl: float,
+        coro_factory: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """Вернуть результат из кэша или получить его и сохранить на ttl секунд
+        
+        Неуспешные ответы не кэшируются. Одновременные промахи по одному ключу
+        ждут единственный запрос к API. На каждом промахе из кэша удаляются
+        истёкшие записи. Блокировка ключа удаляется, как только его результат
+        закэширован: ждущие её задачи найдут запись в кэше при повторной проверке.
+        """
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry and now < entry[0]:
+            return entry[1]
+        
+        self._prune_cache(now)
+        lock = self._cache_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._cache.get(key)
+            if entry and time.monotonic() < entry[0]:
+                return entry[1]
+            
+            result = await coro_factory()
+            if result.get("success"):
+                self._cache[key] = (time.monotonic() + ttl, result)
+                if self._cache_locks.get(key) is lock:
+                    del self._cache_locks[key]
+            return result
+    
+    def _prune_cache(self, now: float) -> None:
+        """Удалить истёкшие записи кэша"""
+        for key in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+            del self._cache[key]
     
     async def get_hotel_types(self, country_id: int) -> Dict[str, Any]:
         """Получить типы отелей для страны"""
-        await self.ensure_session()
-        
+        return await self._cached(
+            ("hoteltypes", country_id),
+            HOTEL_TYPES_TTL,
+            lambda: self._fetch_hotel_types(country_id)
+        )
+    
+    async def _fetch_hotel_types(self, country_id: int) -> Dict[str, Any]:
+        """Загрузить типы отелей для страны из API"""
         params = {
             "active": "true",
             "sortProp": "order",
@@ -380,21 +591,29 @@ class EtoTravelMCP:
             "session": self.session
         }
         
-        url = f"{API_URL}/hotel-actypes/all?{urlencode(params)}"
-        
         try:
-            response = await self.http_client.get(url)
+            response = await self.http_client.get(f"{API_URL}/hotel-actypes/all", params=params)
             response.raise_for_status()
-            data = response.json()
+            data = _json_loads(response.content)
             return {"success": True, "hotel_types": data}
         except Exception as e:
             logger.error(f"Error getting hotel types: {str(e)}")
             return {"success": False, "error": str(e)}
     
     async def get_hotels_by_country(self, country_id: int, departure_id: int = 1) -> Dict[str, Any]:
-        """Получить список отелей по стране"""
-        await self.ensure_session()
+        """Получить список отелей по стране
         
+        Список allhotel от города отправления не зависит, поэтому departure_id
+        не входит в ключ кэша.
+        """
+        return await self._cached(
+            ("hotels", country_id),
+            HOTELS_TTL,
+            lambda: self._fetch_hotels_by_country(country_id)
+        )
+    
+    async def _fetch_hotels_by_country(self, country_id: int) -> Dict[str, Any]:
+        """Загрузить список отелей по стране из API"""
         params = {
             "type": "allhotel",
             "hotcountry": country_id,
@@ -403,19 +622,21 @@ class EtoTravelMCP:
             "session": self.session
         }
         
-        url = f"{BASE_URL}/xml/listdev.php?{urlencode(params)}"
-        
         try:
-            response = await self.http_client.get(url)
+            response = await self.http_client.get(f"{BASE_URL}/xml/listdev.php", params=params)
             response.raise_for_status()
-            data = response.json()
+            data = _json_loads(response.content)
             
-            hotels = data.get("lists", {}).get("hotels", {}).get("hotel", [])
+            hotels = _nested(data, "lists", "hotels", "hotel", default=[])
+            hotels_count = len(hotels)
+            # Оставляем только возвращаемую часть, остальной ответ может собрать GC
+            hotels = hotels[:100]
+            del data
             
             return {
                 "success": True,
-                "hotels_count": len(hotels),
-                "hotels": hotels[:100]
+                "hotels_count": hotels_count,
+                "hotels": hotels
             }
         except Exception as e:
             logger.error(f"Error getting hotels: {str(e)}")
@@ -435,8 +656,6 @@ class EtoTravelMCP:
         hotel_ids: Optional[List[int]] = None
     ) -> Dict[str, Any]:
         """Поиск туров"""
-        await self.ensure_session()
-        
         search_params = {
             "ts_dosearch": "1",
             "s_form_mode": "0",
@@ -460,16 +679,10 @@ class EtoTravelMCP:
         if hotel_ids:
             search_params["s_hotels"] = ",".join(map(str, hotel_ids))
         
-        search_url = f"https://eto.travel/search/?{urlencode(search_params)}"
+        search_url = str(httpx.URL("https://eto.travel/search/", params=search_params))
         
         try:
-            response = await self.http_client.get(
-                search_url,
-                follow_redirects=True,
-                headers={"User-Agent": "Mozilla/5.0"}
-            )
-            
-            request_id = await self._extract_request_id(response.text)
+            request_id = await self._fetch_request_id(search_url)
             
             if not request_id:
                 return {
@@ -478,13 +691,25 @@ class EtoTravelMCP:
                     "search_url": search_url
                 }
             
-            tours = await self._poll_search_results(request_id)
+            # Храним только туры для ответа, остальные лишь считаем; опрос
+            # останавливается, когда счётчик доходит до SEARCH_COUNT_LIMIT
+            tours = []
+            tours_count = 0
+            async with aclosing(self._iter_tours(request_id)) as hits:
+                async for hotel_id, hotel_price, tour in hits:
+                    if tours_count < SEARCH_TOURS_LIMIT:
+                        tours.append({**tour, "hotel_id": hotel_id, "hotel_price": hotel_price})
+                    tours_count += 1
+                    if tours_count >= SEARCH_COUNT_LIMIT:
+                        break
             
             return {
                 "success": True,
                 "request_id": request_id,
-                "tours_count": len(tours),
-                "tours": tours[:50],
+                "tours_count": tours_count,
+                # tours_count не больше SEARCH_COUNT_LIMIT: флаг отмечает, что туров может быть больше
+                "tours_count_capped": tours_count >= SEARCH_COUNT_LIMIT,
+                "tours": tours,
                 "search_url": search_url
             }
             
@@ -492,75 +717,124 @@ class EtoTravelMCP:
             logger.error(f"Error searching tours: {str(e)}")
             return {"success": False, "error": str(e)}
     
-    async def _extract_request_id(self, html: str) -> Optional[str]:
+    def _extract_request_id(self, html: str) -> Optional[str]:
         """Извлечь request_id из HTML ответа"""
-        pattern = r'requestid["\']?\s*[:=]\s*["\']?(\d+)'
-        match = re.search(pattern, html)
-        if match:
-            return match.group(1)
-        return None
+        match = _REQUEST_ID_RE.search(html)
+        return match.group(1) if match else None
     
-    async def _poll_search_results(self, request_id: str, max_attempts: int = 10) -> List[Dict]:
-        """Long polling для получения результатов поиска"""
-        await self.ensure_session()
+    async def _fetch_request_id(self, search_url: str) -> Optional[str]:
+        """Загрузить страницу поиска потоком и найти request_id
         
-        all_tours = []
+        Страницу не дочитываем до конца: соединение закрывается, как только
+        request_id найден.
+        """
+        buffer = ""
+        async with self.http_client.stream(
+            "GET",
+            search_url,
+            follow_redirects=True,
+            headers={"User-Agent": "Mozilla/5.0"}
+        ) as response:
+            async for chunk in response.aiter_text(chunk_size=16384):
+                buffer += chunk
+                match = _REQUEST_ID_RE.search(buffer)
+                # Совпадение в самом конце буфера может быть обрезанным числом
+                if match and match.end() < len(buffer):
+                    return match.group(1)
+                buffer = buffer[-_REQUEST_ID_OVERLAP:]
+        
+        return self._extract_request_id(buffer)
+    
+    async def _iter_tours(
+        self,
+        request_id: str,
+        deadline: float = POLL_DEADLINE
+    ) -> AsyncIterator[Tuple[Any, Any, Dict[str, Any]]]:
+        """Long polling для получения результатов поиска
+        
+        Пауза между опросами адаптивная: пока приходят новые блоки, опрашиваем
+        часто, после пустых ответов удваиваем паузу до POLL_MAX_DELAY, а если
+        сервер сообщает progress — сокращаем паузу по мере его роста. Пауза
+        случайно укорачивается до половины, чтобы параллельные поиски не
+        опрашивали сервер синхронно. Общее время ожидания ограничено deadline
+        секундами, а не числом опросов, поэтому короткие паузы его не сокращают.
+        Туры отдаются по мере разбора блоков как кортежи (hotel_id, hotel_price, tour)
+        без копирования. Опрос прекращается, как только вызывающий код перестаёт
+        читать генератор и закрывает его.
+        """
         last_block = 0
+        delay = POLL_MIN_DELAY
+        sleeper: Optional[asyncio.Task] = None
         
-        for attempt in range(max_attempts):
-            params = {
-                "requestid": request_id,
-                "lastblock": last_block,
-                "referrer": REFERRER,
-                "session": self.session
-            }
-            
-            url = f"{SEARCH_URL}/modresult.php?{urlencode(params)}"
-            
-            try:
-                response = await self.http_client.get(url)
-                response.raise_for_status()
-                data = response.json()
-                
-                blocks = data.get("data", {}).get("block", [])
+        loop = asyncio.get_running_loop()
+        stop_at = loop.time() + deadline
+        attempt = 0
+        
+        try:
+            while loop.time() < stop_at:
+                attempt += 1
+                params = {
+                    "requestid": request_id,
+                    "lastblock": last_block,
+                    "referrer": REFERRER,
+                    "session": self.session
+                }
                 
-                if not blocks:
-                    break
+                # Пауза между опросами идёт параллельно с запросом, а не после него
+                sleeper = asyncio.create_task(asyncio.sleep(random.uniform(delay / 2, delay)))
                 
-                for block in blocks:
-                    last_block = max(last_block, block.get("id", 0))
-                    hotels = block.get("hotel", [])
+                try:
+                    response = await self._poll_client.get("/modresult.php", params=params)
+                    response.raise_for_status()
+                    logger.debug(f"🔄 Опрос {attempt}: {response.http_version}, {len(response.content)} байт")
+                    data = _json_loads(response.content)
+                    
+                    payload = data.get("data") or {}
+                    blocks = payload.get("block") or []
+                    
+                    progress = payload.get("progress")
+                    if blocks:
+                        delay = POLL_MIN_DELAY
+                    elif isinstance(progress, (int, float)):
+                        # Чем ближе поиск к завершению, тем чаще опрашиваем
+                        delay = max(POLL_MIN_DELAY, POLL_MAX_DELAY * (1 - progress / 100))
+                    else:
+                        delay = min(delay * 2, POLL_MAX_DELAY)
                     
-                    for hotel in hotels:
-                        tours = hotel.get("tour", [])
-                        for tour in tours:
-                            tour["hotel_id"] = hotel.get("id")
-                            tour["hotel_price"] = hotel.get("price")
-                            all_tours.append(tour)
+                    seen_block = last_block
+                    for block in blocks:
+                        block_id = block.get("id", 0)
+                        # Блоки из прошлых опросов не разбираем повторно
+                        if block_id and block_id <= seen_block:
+                            continue
+                        if block_id > last_block:
+                            last_block = block_id
+                        
+                        for hotel in block.get("hotel", ()):
+                            hotel_id = hotel.get("id")
+                            hotel_price = hotel.get("price")
+                            for tour in hotel.get("tour", ()):
+                                yield hotel_id, hotel_price, tour
+                    
+                    if payload.get("final") or progress == 100:
+                        break
+                    
+                    await sleeper
                 
-                if data.get("data", {}).get("final"):
+                except Exception as e:
+                    logger.error(f"Error polling results: {str(e)}")
                     break
-                
-                await asyncio.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"Error polling results: {str(e)}")
-                break
-        
-        return all_tours
+        finally:
+            if sleeper and not sleeper.done():
+                sleeper.cancel()
     
     async def find_country(self, query: str) -> Dict[str, Any]:
         """Найти страну по названию"""
-        if not self.dictionary:
-            await self.load_dictionary()
+        await self._ensure_dictionary()
         
-        countries = self.dictionary.get("lists", {}).get("allcountry", {}).get("country", [])
         query_lower = query.lower()
         
-        found = [
-            c for c in countries 
-            if query_lower in c.get("name", "").lower()
-        ]
+        found = [e.item for e in self._countries_lc if query_lower in e.name_lower]
         
         return {
             "success": True,
@@ -571,15 +845,13 @@ class EtoTravelMCP:
     
     async def find_region(self, country_id: int, query: str) -> Dict[str, Any]:
         """Найти регион в стране"""
-        if not self.dictionary:
-            await self.load_dictionary()
+        await self._ensure_dictionary()
         
-        regions = self.dictionary.get("lists", {}).get("regions", {}).get("region", [])
         query_lower = query.lower()
         
         found = [
-            r for r in regions 
-            if r.get("country") == country_id and query_lower in r.get("name", "").lower()
+            e.item for e in self._regions_by_country.get(country_id, [])
+            if query_lower in e.name_lower
         ]
         
         return {
@@ -592,26 +864,34 @@ class EtoTravelMCP:
     
     async def get_popular_countries(self) -> Dict[str, Any]:
         """Получить популярные страны"""
-        if not self.dictionary:
-            await self.load_dictionary()
-        
-        countries = self.dictionary.get("lists", {}).get("allcountry", {}).get("country", [])
-        popular = [c for c in countries if c.get("popular") == 1]
+        await self._ensure_dictionary()
         
         return {
             "success": True,
-            "popular_count": len(popular),
-            "countries": popular
+            "popular_count": len(self._popular_countries),
+            "countries": list(self._popular_countries)
         }
     
+    async def aclose(self):
+        """Закрыть HTTP клиенты"""
+        if self._prefetch is not None and not self._prefetch.done():
+            self._prefetch.cancel()
+        await self.http_client.aclose()
+        await self._poll_client.aclose()
+    
     async def run(self):
         """Запуск MCP сервера"""
-        async with stdio_server() as (read_stream, write_stream):
-            await self.server.run(
-                read_stream,
-                write_stream,
-                self.server.create_initialization_options()
-            )
+        # Справочник грузится, пока клиент проходит инициализацию
+        self._prefetch = asyncio.create_task(self.load_dictionary())
+        try:
+            async with stdio_server() as (read_stream, write_stream):
+                await self.server.run(
+                    read_stream,
+                    write_stream,
+                    self.server.create_initialization_options()
+                )
+        finally:
+            await self.aclose()
 
 
 # Тестовый режим
@@ -634,9 +914,16 @@ async def test_mode():
     else:
         print(f"❌ Ошибка: {result.get('error')}")
     
+    # Тесты 2-4 не зависят друг от друга — выполняем их параллельно
+    country_result, popular_result, hotel_types_result = await asyncio.gather(
+        mcp.find_country("Египет"),
+        mcp.get_popular_countries(),
+        mcp.get_hotel_types(1)  # 1 = Египет
+    )
+    
     # Тест 2: Поиск страны
     print("\n2️⃣ Тест: Поиск страны 'Египет'...")
-    result = await mcp.find_country("Египет")
+    result = country_result
     if result.get("success") and result.get("found_count") > 0:
         country = result["countries"][0]
         print(f"✅ Найдено! ID: {country['id']}, Название: {country['name']}")
@@ -645,7 +932,7 @@ async def test_mode():
     
     # Тест 3: Популярные страны
     print("\n3️⃣ Тест: Получение популярных стран...")
-    result = await mcp.get_popular_countries()
+    result = popular_result
     if result.get("success"):
         print(f"✅ Успешно! Найдено {result['popular_count']} популярных стран:")
         for country in result["countries"][:5]:
@@ -655,7 +942,7 @@ async def test_mode():
     
     # Тест 4: Типы отелей
     print("\n4️⃣ Тест: Получение типов отелей для Египта...")
-    result = await mcp.get_hotel_types(1)  # 1 = Египет
+    result = hotel_types_result
     if result.get("success"):
         print(f"✅ Успешно! Доступные типы:")
         for hotel_type in result.get("hotel_types", [])[:5]:
@@ -669,7 +956,7 @@ async def test_mode():
     print("   python mcp_server.py")
     print("\n💡 И подключи к Cursor через настройки MCP")
     
-    await mcp.http_client.aclose()
+    await mcp.aclose()
 
 
 async def main():
@@ -689,4 +976,10 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # uvloop быстрее стандартного цикла, но доступен не везде (например, Windows)
+    try:
+        import uvloop
+        runner = uvloop.run
+    except ImportError:
+        runner = asyncio.run
+    runner(main())
\ No newline at end of file